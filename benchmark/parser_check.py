@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+# This script checks and benchmarks the commit message parser of the hooks,
+# hooks/trac_commit_parser.py.
+#
+# parse_message has to find exactly the same commands, ticket ids and worked
+# hours as the regular expressions command_re, ticket_re and hours_re, which
+# define the syntax. This is checked on CORPUS, messages written to hit the
+# corners of that syntax, and on --messages random messages made of fragments
+# of it, generated from --seed. Any difference is printed, and makes the
+# script exit with status 1.
+#
+# Then both are timed on pathological messages of growing size: long runs of
+# letters, references and separators, like pasted logs. The regular
+# expressions take quadratic time on some of them, parse_message should grow
+# linearly on all; the time per 1000 characters is printed for every size.
+#
+#   python benchmark/parser_check.py
+#   python benchmark/parser_check.py --messages 2000000 --max-size 64000
+
+import sys
+import os
+import time
+import random
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'hooks'))
+from trac_commit_parser import parse_message, command_re, ticket_re, hours_re
+
+CORPUS = [
+    '',
+    'refs #1',
+    'Refs #1',
+    'fixes #10 and #12, and refs #12. worked 10.2h',
+    'Changed blah and foo to do this or that. Fixes #10 and #12, and refs '
+    '#12. worked 10.2h',
+    'closes #1, #2 & #3 and #4',
+    'close #1,#2,,#3 &&#4',
+    'see #1and#2 and #3 and  #4',
+    'refs ticket:1, ticket 2 and issue:3 and bug 4',
+    'refs ticket:x ticket: 5 ticket  6',
+    'refs:#1',
+    'refs\n#1',
+    'refs  #1',
+    'debug12 and bug7',
+    'refs issue12',
+    're#1 see#2',
+    '#1 without an action',
+    'a #1 b#2',
+    'worked 1h',
+    'worked1.5h worked  2h worked .h worked h',
+    'overworked 3h and reworked 4.0h',
+    'worked 1h worked 2h refs #1 worked 3.h',
+    'workedworked 5h',
+    'refs #1 worked 2h\n\nfixes #2\nworked 3h',
+    'refs #\nrefs ticket\nrefs ticket:',
+    'refs #1 and and #2',
+    'refs #1 and\n#2',
+    'refs #99999999999999999999',
+    'x' * 500 + ' refs #1',
+    'refs #1 ' * 50,
+    '#1 and ' * 50,
+    'fix #1, ' * 30 + 'worked 4h',
+    '- fixes #1\n- refs #2\n- worked 1.25h\n',
+    'Merge branch \'feature\' (refs #7)',
+    '[refs #8] (see #9)',
+]
+
+FRAGMENTS = ['refs', 'Refs', 'fixes', 'close', 'closes', 'see', 're', 'and',
+             ' and ', 'ticket', 'ticket:', 'ticket ', 'issue', 'bug', 'debug',
+             '#', '#1', '#12', '1', '23', ',', ', ', ' & ', '&', ' ', '  ',
+             '\n', ':', '.', 'h', 'x', 'worked', 'worked ', ' 1.5h', '2h',
+             'aworked3h', 'workedworked']
+
+
+def reference(text):
+    """Returns what the regular expressions find in the message text."""
+    return ([(action, ticket_re.findall(tickets))
+             for action, tickets in command_re.findall(text)],
+            hours_re.findall(text))
+
+
+def random_messages(count, seed):
+    rnd = random.Random(seed)
+    for i in xrange(count):
+        yield ''.join([rnd.choice(FRAGMENTS)
+                       for j in xrange(rnd.randint(1, 20))])
+
+
+def check(messages):
+    """Compares parse_message with the regular expressions on messages,
+    returns the number of differences."""
+    differences = 0
+    for text in messages:
+        expected = reference(text)
+        found = parse_message(text)
+        if found != expected:
+            differences += 1
+            print 'Difference for %r:' % text
+            print '  expected %r' % (expected,)
+            print '  found    %r' % (found,)
+    return differences
+
+
+PATHOLOGICAL = [
+    ('letters', lambda size: 'a' * size),
+    ('letters and reference', lambda size: 'a' * (size - 3) + ' #1'),
+    ('references', lambda size: '#1 and ' * (size // 7)),
+    ('commands', lambda size: 'refs #1 ' * (size // 8)),
+    ('separators', lambda size: 'refs #1' + ', & ' * (size // 4)),
+    ('ticket words', lambda size: 'ticket' * (size // 6)),
+    ('worked', lambda size: 'worked ' * (size // 7)),
+    ('digits', lambda size: '#' + '1' * size),
+]
+
+
+def timed(function, text):
+    """Returns the seconds function takes on text, the best of three."""
+    best = None
+    for i in xrange(3):
+        start = time.time()
+        function(text)
+        seconds = time.time() - start
+        best = best is None and seconds or min(best, seconds)
+    return best
+
+
+def benchmark(sizes, regex_limit):
+    print '%-24s %8s %14s %14s' % ('message', 'size', 'parser ms/1k',
+                                   'regex ms/1k')
+    for name, make in PATHOLOGICAL:
+        for size in sizes:
+            text = make(size)
+            parser = timed(parse_message, text) * 1000000 / max(len(text), 1)
+            if len(text) <= regex_limit:
+                regex = '%14.3f' % (timed(reference, text) * 1000000 /
+                                    max(len(text), 1))
+            else:
+                regex = '%14s' % '-'
+            print '%-24s %8d %14.3f %s' % (name, len(text), parser, regex)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--messages', type='int', default=200000,
+                      help='random messages to check [default: %default]')
+    parser.add_option('--seed', type='int', default=1,
+                      help='seed of the random messages [default: %default]')
+    parser.add_option('--max-size', type='int', default=32000,
+                      help='size of the largest pathological message '
+                           '[default: %default]')
+    parser.add_option('--regex-limit', type='int', default=8000,
+                      help='largest message to time the regular expressions '
+                           'on [default: %default]')
+    options, args = parser.parse_args()
+
+    print 'Checking %d corpus and %d random messages...' % (len(CORPUS),
+                                                           options.messages)
+    differences = check(CORPUS)
+    differences += check(random_messages(options.messages, options.seed))
+
+    sizes = []
+    size = 1000
+    while size <= options.max_size:
+        sizes.append(size)
+        size *= 2
+    benchmark(sizes, options.regex_limit)
+
+    if differences:
+        print 'FAILED: %d messages parsed differently' % differences
+        sys.exit(1)
+    print 'All messages parsed the same'
+
+
+if __name__ == '__main__':
+    main()
@@ -65,18 +65,42 @@
 # of:
 #
 #    Changed blah and foo to do this or that. Fixes #10 and #12, and refs #12. worked 10.2h
+#
+# Every ticket reference is also recorded in the git_ticket_commit table, which
+# can be queried with trac_commit_index.py. Keep it next to this hook.
+#
+# Commits that were never pushed through this hook, like the history from
+# before it was installed, can be linked to their tickets afterwards with
+#
+#    python trac-post-receive-hook.py --backfill [rev-list arguments]
+#
+# run inside the repository. This adds the message of every commit that
+# references a ticket as a comment dated at the commit, for the commits of
+# the BRANCHES, or those of them selected by the given rev-list arguments
+# (e.g. v1.0..master). Commits that are on none of the BRANCHES, like those
+# of unmerged feature branches, are left for this hook to add when they are
+# merged. Tickets are not closed and no hours or notifications are added, as
+# the tickets already reflect what happened since.
 
 import sys
 import os
 import re
-from subprocess import Popen, PIPE
-from datetime import datetime
-from operator import itemgetter
-import trac
 import time
+from subprocess import Popen, PIPE
+from datetime import datetime, timedelta
+from trac_commit_parser import parse_message
+from trac_notify_spool import NotifySpool, PendingNotifications, spawn_worker
+from trac_commit_index import upgrade_commit_index, add_references
+from trac_hook_timing import timing
+from trac_git_log import read_commits, chunks
+from trac_push_refs import (branch_patterns, is_checked_ref, ref_updates,
+                            push_args, RefTracker, NULL_SHA)
 
 TRAC_ENV = '/home/jens/tractest/'
 GIT_PATH = '/usr/bin/git'
+# Branches handled by this hook: names, glob patterns like 'release/*' or
+# compiled regular expressions like re.compile(r'feature/[0-9]+'), see
+# trac_push_refs.py.
 BRANCHES = ['master']
 COMMANDS = {'close':      intern('close'),
             'closed':     intern('close'),
@@ -92,21 +116,34 @@ COMMANDS = {'close':      intern('close'),
 
 ADD_HOURS = False
 
+# Set this to True to update every ticket only once per push: the commits of
+# the push referencing a ticket are then listed in a single comment, the
+# ticket is closed if any of them closes it, their worked hours are added up
+# and only one notification is sent.
+COALESCE_COMMITS = False
+
+# Ticket notifications are written to a spool in the Trac environment and sent
+# by trac_notify_spool.py, which must be kept next to this hook. Set this to
+# False when the spool is drained by a cron job instead of after every push.
+SPAWN_NOTIFY_WORKER = True
+
+# Number of times a push is retried when an other process updated the same
+# commits at the same time.
+PUSH_ATTEMPTS = 3
+# Number of commits written per transaction by --backfill.
+BACKFILL_BATCH_SIZE = 5000
+
+# Append a record with the time spent in each phase of every push to this
+# file, e.g. os.path.join(TRAC_ENV, 'log', 'post-receive-timing.log'), and
+# with PROFILE_LOG a cProfile report as well. See trac_hook_timing.py.
+TIMING_LOG = None
+PROFILE_LOG = None
+GIT_SEEN_VERSION = 1
+
 # Use the egg cache of the environment if not other python egg cache is given.
 if not 'PYTHON_EGG_CACHE' in os.environ:
     os.environ['PYTHON_EGG_CACHE'] = '/tmp/.egg-cache'
 
-# Construct and compile regular expressions for finding ticket references and
-# actions in commit messages.
-ticket_prefix = '(?:#|(?:ticket|issue|bug)[: ]?)'
-ticket_reference = ticket_prefix + '[0-9]+'
-ticket_command =  (r'(?P<action>[A-Za-z]*).?'
-                   '(?P<ticket>%s(?:(?:[, &]*|[ ]?and[ ]?)%s)*)' %
-                   (ticket_reference, ticket_reference))
-command_re = re.compile(ticket_command)
-ticket_re = re.compile(ticket_prefix + '([0-9]+)')
-hours_re = re.compile("worked\s*(?P<hours>[0-9.]+)h")
-
 
 def call_git(command, args):
 
@@ -134,193 +171,642 @@ def readTicketValue(name, tipe, ticket, env,default=0):
  	    return tipe(val[2] or default)
  	return default
 
+# end found
+
+def change_time_functions():
+    """Returns the functions converting a change time to the value Trac
+    stores and back, and the resolution of those values. Trac is imported
+    here rather than at the top, so handing a push to the hook daemon does
+    not load it."""
+    from trac.util.datefmt import utc
+    try:
+        # Trac 0.12 and later store change times with microsecond
+        # resolution, older versions only keep whole seconds.
+        from trac.util.datefmt import to_utimestamp, from_utimestamp
+        return to_utimestamp, from_utimestamp, timedelta(microseconds=1)
+    except ImportError:
+        from trac.util.datefmt import to_timestamp
+        return (to_timestamp, lambda value: datetime.fromtimestamp(value, utc),
+                timedelta(seconds=1))
+
+
+class ChangeTimeAllocator(object):
+    """Hands out strictly increasing change times per ticket.
+
+    Trac can store only one change per ticket per time unit, so every change
+    time handed out for a ticket is moved past both the newest change already
+    in ticket_change and the previous time handed out during this push.
+    """
 
-try:
-    import trac.util.datefmt
-    to_timestamp = trac.util.datefmt.to_timestamp
-except Exception:
-    to_timestamp = identity
+    def __init__(self):
+        self.to_stored, self.from_stored, self.resolution = \
+            change_time_functions()
+        self.last = {}
+
+    def stored_time(self, tkt_id, db):
+        cursor = db.cursor()
+        cursor.execute("SELECT MAX(time) FROM ticket_change WHERE ticket=%s",
+                       (tkt_id,))
+        row = cursor.fetchone()
+        if not row or row[0] is None:
+            return None
+        return self.from_stored(row[0])
+
+    def allocate(self, tkt_id, now, db):
+        """Returns a change time for ticket tkt_id that is not before now."""
+        tkt_id = int(tkt_id)
+        if self.resolution.seconds:
+            now = now.replace(microsecond=0)
+        if tkt_id not in self.last:
+            self.last[tkt_id] = self.stored_time(tkt_id, db)
+        last = self.last[tkt_id]
+        if last is not None and now <= last:
+            now = last + self.resolution
+        self.last[tkt_id] = now
+        return now
+
+
+class BackfillTimeAllocator(ChangeTimeAllocator):
+    """Hands out change times at the time of old commits.
+
+    The changes are not moved past the newest change of the ticket, only past
+    the changes already stored or handed out at the same time.
+    """
 
+    def __init__(self):
+        ChangeTimeAllocator.__init__(self)
+        self.taken = {}
+
+    def stored_times(self, tkt_id, db):
+        cursor = db.cursor()
+        cursor.execute("SELECT DISTINCT time FROM ticket_change WHERE ticket=%s",
+                       (tkt_id,))
+        return set([row[0] for row in cursor])
+
+    def allocate(self, tkt_id, when, db):
+        tkt_id = int(tkt_id)
+        if self.resolution.seconds:
+            when = when.replace(microsecond=0)
+        if tkt_id not in self.taken:
+            self.taken[tkt_id] = self.stored_times(tkt_id, db)
+        taken = self.taken[tkt_id]
+        while self.to_stored(when) in taken:
+            when += self.resolution
+        taken.add(self.to_stored(when))
+        return when
+
+
+def upsert_sql(env, table, columns, key):
+    """Returns a statement inserting a row into table, or replacing the row
+    with the same key, using the native upsert of the database backend."""
+    scheme = env.config.get('trac', 'database').split(':', 1)[0]
+    values = (table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+    if scheme == 'sqlite':
+        return 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % values
+    if scheme == 'mysql':
+        return 'REPLACE INTO %s (%s) VALUES (%s)' % values
+    return ('INSERT INTO %s (%s) VALUES (%s) ' % values +
+            'ON CONFLICT (%s) DO UPDATE SET %s' % (', '.join(key),
+            ', '.join(['%s=EXCLUDED.%s' % (column, column)
+                       for column in columns if column not in key])))
+
+
+def upgrade_git_seen(db):
+    """Creates the git_seen table, or migrates the original git_seen table
+    without any key, and records its version in Trac's system table."""
+    cursor = db.cursor()
+    cursor.execute("SELECT value FROM system WHERE name='git_seen_version'")
+    row = cursor.fetchone()
+    version = row and int(row[0]) or 0
+    if version >= GIT_SEEN_VERSION:
+        return
 
-def save_custom_field_value( db, ticket_id, field, value ):
-    cursor = db.cursor();
-    cursor.execute("SELECT * FROM ticket_custom "
-                   "WHERE ticket=%s and name=%s", (ticket_id, field))
-    if cursor.fetchone():
-        cursor.execute("UPDATE ticket_custom SET value=%s "
-                       "WHERE ticket=%s AND name=%s",
-                       (value, ticket_id, field))
+    try:
+        cursor.execute('SELECT COUNT(*) FROM git_seen')
+        cursor.fetchone()
+        exists = True
+    except (db.OperationalError, db.ProgrammingError):
+        # git_seen is missing
+        db.rollback()
+        cursor = db.cursor()
+        exists = False
+
+    if exists:
+        cursor.execute('CREATE TABLE git_seen_new (sha1 VARCHAR(40) PRIMARY KEY)')
+        cursor.execute('INSERT INTO git_seen_new (sha1) '
+                       'SELECT DISTINCT sha1 FROM git_seen')
+        cursor.execute('DROP TABLE git_seen')
+        cursor.execute('ALTER TABLE git_seen_new RENAME TO git_seen')
     else:
-        cursor.execute("INSERT INTO ticket_custom (ticket,name, "
-                       "value) VALUES(%s,%s,%s)",
-                       (ticket_id, field, value))
+        cursor.execute('CREATE TABLE git_seen (sha1 VARCHAR(40) PRIMARY KEY)')
+
+    if row:
+        cursor.execute("UPDATE system SET value=%s WHERE name='git_seen_version'",
+                       (str(GIT_SEEN_VERSION),))
+    else:
+        cursor.execute("INSERT INTO system (name, value) "
+                       "VALUES ('git_seen_version', %s)", (str(GIT_SEEN_VERSION),))
     db.commit()
 
-DONTUPDATE = "DONTUPDATE"
 
-def save_ticket_change( db, ticket_id, author, change_time, field, oldvalue, newvalue, dontinsert=False):
-    """tries to save a ticket change,
+def get_seen_commits(db, shas):
+    """Returns the set of shas that are already in git_seen."""
+    seen = set()
+    cursor = db.cursor()
+    for chunk in chunks(shas):
+        cursor.execute('SELECT sha1 FROM git_seen WHERE sha1 IN (%s)'
+                       % ', '.join(['%s'] * len(chunk)), chunk)
+        seen.update(row[0] for row in cursor.fetchall())
+    return seen
 
-       dontinsert means do not add the change if it didnt already exist
-    """
-    if isinstance(change_time,datetime):
-        change_time = to_timestamp(change_time)
-    #print "change_time: %s" % change_time
-    cursor = db.cursor();
-    sql = """SELECT * FROM ticket_change
-             WHERE ticket=%s and author=%s and time=%s and field=%s"""
-
-    cursor.execute(sql, (ticket_id, author, change_time, field))
-    if cursor.fetchone():
-        if oldvalue == DONTUPDATE:
-            cursor.execute("""UPDATE ticket_change  SET  newvalue=%s
-                       WHERE ticket=%s and author=%s and time=%s and field=%s""",
-                           ( newvalue, ticket_id, author, change_time, field))
 
-        else:
-            cursor.execute("""UPDATE ticket_change  SET oldvalue=%s, newvalue=%s
-                       WHERE ticket=%s and author=%s and time=%s and field=%s""",
-                           (oldvalue, newvalue, ticket_id, author, change_time, field))
-    else:
-        if oldvalue == DONTUPDATE:
-            oldvalue = '0'
-        if not dontinsert:
-            cursor.execute("""INSERT INTO ticket_change  (ticket,time,author,field, oldvalue, newvalue)
-                        VALUES(%s, %s, %s, %s, %s, %s)""",
-                           (ticket_id, change_time, author, field, oldvalue, newvalue))
-    db.commit()
+def mark_seen(db, shas):
+    """Inserts shas into git_seen, without committing. This raises an
+    IntegrityError when an other process has seen one of them in the
+    meantime."""
+    cursor = db.cursor()
+    for chunk in chunks(shas):
+        cursor.executemany('INSERT INTO git_seen (sha1) VALUES (%s)',
+                           [(sha,) for sha in chunk])
 
-# end found
 
-def handle_commit(commit, env):
-    from trac.ticket.notification import TicketNotifyEmail
-    from trac.ticket import Ticket
-    from trac.ticket.web_ui import TicketModule
-    from trac.util.text import to_unicode
-    from trac.util.datefmt import utc
+def forget_seen(db, shas):
+    """Removes shas from git_seen, without committing, so they can still be
+    added with --backfill."""
+    cursor = db.cursor()
+    for chunk in chunks(shas):
+        cursor.execute('DELETE FROM git_seen WHERE sha1 IN (%s)'
+                       % ', '.join(['%s'] * len(chunk)), chunk)
 
-    msg = to_unicode(call_git('rev-list', ['-n', '1', commit, '--pretty=medium']).rstrip())
-    eml = to_unicode(call_git('rev-list', ['-n', '1', commit, '--pretty=format:%ae']).splitlines()[1])
-    now = datetime.now(utc)
-    content = msg.split('\n\n', 1)[1]
 
+class PushTransaction(object):
+    """Unit of work of one push.
+
+    The ticket_change and ticket_custom rows written for the worked hours, and
+    the git_ticket_commit rows of the references, are collected here and
+    flushed with one statement per table when the push is committed, in the
+    same transaction as the git_seen rows and the ticket changes themselves.
+    Notifications are only spooled once that transaction has been committed.
+    """
+
+    def __init__(self, env, spool):
+        self.env = env
+        self.spool = spool
+        self.times = ChangeTimeAllocator()
+        self.cnums = {}
+        self.changes = {}
+        self.custom = {}
+        self.notifications = PendingNotifications()
+        self.coalesced = {}
+        self.references = []
+        self.failed = []
+
+    def next_cnum(self, tkt_id, db):
+        """Returns the sequence number of the next comment on ticket tkt_id.
+
+        Every change of a ticket has exactly one comment row, so the number of
+        comment rows is the number of changes so far. It is only queried for
+        the first change of each ticket in the push.
+        """
+        tkt_id = int(tkt_id)
+        if tkt_id not in self.cnums:
+            cursor = db.cursor()
+            cursor.execute("SELECT COUNT(*) FROM ticket_change "
+                           "WHERE ticket=%s AND field='comment'", (tkt_id,))
+            self.cnums[tkt_id] = cursor.fetchone()[0]
+        self.cnums[tkt_id] += 1
+        return self.cnums[tkt_id]
+
+    def save_ticket_change(self, tkt_id, author, change_time, field,
+                           oldvalue, newvalue):
+        if isinstance(change_time, datetime):
+            change_time = self.times.to_stored(change_time)
+        self.changes[(int(tkt_id), change_time, field)] = (author, oldvalue,
+                                                           newvalue)
+
+    def save_custom_field_value(self, tkt_id, field, value):
+        self.custom[(int(tkt_id), field)] = value
+
+    def read_custom_field_value(self, ticket, field, tipe, default=0):
+        """Returns the value of the custom field of ticket, including the
+        changes not yet flushed."""
+        if (ticket.id, field) in self.custom:
+            return tipe(self.custom[(ticket.id, field)] or default)
+        return readTicketValue(field, tipe, ticket, self.env, default)
+
+    def notify(self, tkt_id, modtime):
+        if self.spool is not None:
+            self.notifications.add(tkt_id, modtime)
+
+    def reference(self, commit, tickets, ref=None):
+        """Adds the references of commit to tickets, a dict of the actions per
+        ticket id, to the commit index."""
+        from trac.util.text import to_unicode
+
+        for tkt_id, actions in tickets.iteritems():
+            for action in sorted(set(actions)):
+                self.references.append((commit['sha'], int(tkt_id), action,
+                                        to_unicode(commit['email']),
+                                        commit['time'], ref))
+
+    def forget(self, commit):
+        """Drops the references and postponed updates of commit, which could
+        not be handled."""
+        self.references = [reference for reference in self.references
+                           if reference[0] != commit['sha']]
+        for tkt_id, updates in self.coalesced.items():
+            updates[:] = [update for update in updates
+                          if update[0] is not commit]
+            if not updates:
+                del self.coalesced[tkt_id]
+
+    def coalesce(self, tkt_id, commit, actions, hours):
+        """Postpones the update of ticket tkt_id by commit until the whole
+        push has been read, see handle_coalesced."""
+        self.coalesced.setdefault(int(tkt_id), []).append((commit, actions,
+                                                           hours))
+
+    def flush(self, db):
+        cursor = db.cursor()
+        if self.changes:
+            cursor.executemany(upsert_sql(self.env, 'ticket_change',
+                ('ticket', 'time', 'author', 'field', 'oldvalue', 'newvalue'),
+                ('ticket', 'time', 'field')),
+                [(tkt_id, change_time, author, field, oldvalue, newvalue)
+                 for (tkt_id, change_time, field), (author, oldvalue, newvalue)
+                 in sorted(self.changes.iteritems())])
+        if self.custom:
+            cursor.executemany(upsert_sql(self.env, 'ticket_custom',
+                ('ticket', 'name', 'value'), ('ticket', 'name')),
+                [(tkt_id, field, value)
+                 for (tkt_id, field), value in sorted(self.custom.iteritems())])
+        add_references(db, self.references)
+        self.changes.clear()
+        self.custom.clear()
+        self.references = []
+
+    def commit(self):
+        """Writes everything in a single commit, or rolls it all back."""
+        db = self.env.get_db_cnx()
+        try:
+            with timing.phase('flush'):
+                self.flush(db)
+            with timing.phase('commit'):
+                db.commit()
+        except:
+            db.rollback()
+            raise
+        if self.notifications:
+            with timing.phase('spool'):
+                self.spool.enqueue(self.notifications)
+            timing.count('notifications', len(self.notifications))
+            self.notifications.clear()
+
+
+def commit_tickets(commit):
+    """Returns the actions per ticket id and the worked hours strings found in
+    the message of commit."""
+    content = commit['msg'].split('\n\n', 1)[1]
     tickets = {}
-    for cmd, tkts in command_re.findall(content):
+    commands, hours = parse_message(content)
+    for cmd, tkt_ids in commands:
         action = COMMANDS.get(cmd.lower())
-	#print "action: %s " % action
         if action:
-            for tkt_id in ticket_re.findall(tkts):
+            for tkt_id in tkt_ids:
                 tickets.setdefault(tkt_id, []).append(action)
+    return tickets, hours
+
+
+def update_ticket(env, push, tkt_id, actions, author, msg, hours):
+    """Saves a change of ticket tkt_id by author with the comment msg, as part
+    of the PushTransaction push. The ticket is closed if 'close' is in
+    actions, and with ADD_HOURS the hours worked are added to it."""
+    from trac.ticket import Ticket
+    from trac.util.datefmt import utc
+
+    db = env.get_db_cnx()
+    with timing.phase('ticket'):
+        ticket = Ticket(env, int(tkt_id), db)
+    #print "ticket: %s" % ticket
+    if ADD_HOURS and hours:
+        #ADD hours to ticket
+        #code from http://trac-hacks.org/browser/timingandestimationplugin/branches/trac0.11/timingandestimationplugin/ticket_daemon.py
+        totalHours = push.read_custom_field_value(ticket, "totalhours", convertfloat)
+        newtotal = str(totalHours+hours)
+        cl = ticket.get_changelog()
+        if cl:
+            most_recent_change = cl[-1]
+            change_time = most_recent_change[0]
+            change_author = most_recent_change[1]
+        else:
+            change_time = ticket.time_created
+            change_author = ticket.values["reporter"]
+        push.save_ticket_change(tkt_id, change_author, change_time, "hours", '0.0', str(hours))
+        push.save_ticket_change(tkt_id, change_author, change_time, "totalhours", str(totalHours), str(newtotal))
+        push.save_custom_field_value(tkt_id, "hours", '0')
+        push.save_custom_field_value(tkt_id, "totalhours", str(newtotal))
+
+    if 'close' in actions:
+        ticket['status'] = 'closed'
+        ticket['resolution'] = 'fixed'
+
+    # The change is committed together with the rest of the push.
+    with timing.phase('save'):
+        when = push.times.allocate(tkt_id, datetime.now(utc), db)
+        ticket.save_changes(author, msg, when, db, push.next_cnum(tkt_id, db))
+    timing.count('tickets')
+    push.notify(tkt_id, when)
+
+
+def handle_commit(commit, env, push, ref=None):
+    """Updates the tickets referenced by commit, a dict as returned by
+    parse_commit and pushed to ref (several refs separated by spaces), as part
+    of the PushTransaction push."""
+    from trac.util.text import to_unicode
+
+    with timing.phase('parse'):
+        tickets, hours = commit_tickets(commit)
+    push.reference(commit, tickets, ref)
+    # The hours are equally distributed across the tickets.
+    hours = ADD_HOURS and hours and tickets and \
+            float(hours[0]) / len(tickets) or 0.0
 
     for tkt_id, actions in tickets.iteritems():
+        if COALESCE_COMMITS:
+            push.coalesce(tkt_id, commit, actions, hours)
+            continue
         try:
-            db = env.get_db_cnx()
-            ticket = Ticket(env, int(tkt_id), db)
-	    #print "ticket: %s" % ticket
-    	    if ADD_HOURS:
- 		#print "message: %s" % content
-		hours = hours_re.findall(content)
-		if hours:
-			#ADD hours to ticket
-			hours =  float(hours[0])/len(tickets)
-			#code from http://trac-hacks.org/browser/timingandestimationplugin/branches/trac0.11/timingandestimationplugin/ticket_daemon.py
-			#print "hours: %s" % hours
-			totalHours = readTicketValue("totalhours", convertfloat,ticket,env)
-			#print "totalhours: %s" % totalHours
-			newtotal = str(totalHours+hours)
-			#print "newtotal: %s" % newtotal
-			cl = ticket.get_changelog()
-			if cl:
-				#print "cl: %s" % cl
-				most_recent_change = cl[-1]
-				change_time  = most_recent_change[0]
-				#print "changetime: %s" % change_time
-				author = most_recent_change[1]
-			else:
-				change_time = ticket.time_created
-				author = ticket.values["reporter"]
-			db =  env.get_db_cnx()
-			#print "saving changes"
-			save_ticket_change( db, tkt_id, author, change_time, "hours", '0.0', str(hours) )
-			save_ticket_change( db, tkt_id, author, change_time, "totalhours", str(totalHours), str(newtotal))
-			save_custom_field_value( db, tkt_id, "hours", '0')	
-			save_custom_field_value( db, tkt_id, "totalhours", str(newtotal) )
-			#print "hour changes saved"
-
-            if 'close' in actions:
-                ticket['status'] = 'closed'
-                ticket['resolution'] = 'fixed'
-	
-            # determine sequence number...
-            cnum = 0
-            tm = TicketModule(env)
-            for change in tm.grouped_changelog_entries(ticket, db):
-                if change['permanent']:
-                    cnum += 1
-
-            ticket.save_changes(eml, msg, now, db, cnum + 1)
-            db.commit()
-
-            tn = TicketNotifyEmail(env)
-            tn.notify(ticket, newticket=0, modtime=now)
-            
-            #dirty workaround for being able to save only one ticket/second, should be fixed in track 0.12 (1 ticket/microsecond)
-            #see also http://trac.edgewall.org/ticket/9993
-            time.sleep(1)
-            now = datetime.now(utc)
-
+            update_ticket(env, push, tkt_id, actions,
+                          to_unicode(commit['email']),
+                          to_unicode(commit['msg']), hours)
         except Exception, e:
-            print 'Unexpected error while processing commit %s, for ticket ID %s: %s %s' % (commit, tkt_id, e.__class__,e)
+            print 'Unexpected error while processing commit %s, for ticket ID %s: %s %s' % (commit['sha'], tkt_id, e.__class__,e)
 
-def handle_ref(old, new, ref, env):
-    # If something else than the master branch (or whatever is contained by the
-    # constant BRANCHES) was pushed, skip this ref.
-    if not ref.startswith('refs/heads/') or ref[11:] not in BRANCHES:
-        return
 
-    # Get the list of hashs for commits in the changeset.
-    args = (old == '0' * 40) and [new] or [new, '^' + old]
-    pending_commits = call_git('rev-list', args).splitlines()
+def handle_coalesced(env, push):
+    """Updates every ticket referenced in the push once, for all commits
+    referencing it, see COALESCE_COMMITS."""
+    from trac.util.text import to_unicode
+
+    for tkt_id, updates in sorted(push.coalesced.iteritems()):
+        # List the commits in the order they were made. git log lists the
+        # newest first, which also orders commits made in the same second.
+        updates.reverse()
+        updates.sort(key=lambda update: update[0]['time'])
+        actions = []
+        authors = []
+        msgs = []
+        hours = 0.0
+        for commit, commit_actions, commit_hours in updates:
+            actions.extend(commit_actions)
+            if commit['email'] not in authors:
+                authors.append(commit['email'])
+            msgs.append(commit['msg'])
+            hours += commit_hours
+        msg = '\n\n'.join(msgs)
+        if len(authors) > 1:
+            msg = '%d commits by %s:\n\n%s' % (len(msgs), ', '.join(authors),
+                                                msg)
+        elif len(msgs) > 1:
+            msg = '%d commits:\n\n%s' % (len(msgs), msg)
+        # The change is made by the author of the newest commit, the others
+        # are named in the comment.
+        try:
+            update_ticket(env, push, tkt_id, actions,
+                          to_unicode(updates[-1][0]['email']), to_unicode(msg),
+                          hours)
+        except Exception, e:
+            print 'Unexpected error while processing ticket ID %s: %s %s' % (tkt_id, e.__class__, e)
+    push.coalesced.clear()
+
+def read_push_commits(updates):
+    """Yields the parsed metadata of the new commits of all ref updates, with
+    the frozenset of the refs each commit is on, using one git log process
+    for all of them."""
+    if len(updates) == 1:
+        # All commits are on the one pushed ref. Without --topo-order git
+        # streams them, instead of holding all of them until the last one.
+        refs = frozenset([updates[0][2]])
+        for commit in read_commits(push_args(updates), GIT_PATH):
+            commit['refs'] = refs
+            yield commit
+        return
+    tracker = RefTracker(updates)
+    args = ['--topo-order'] + push_args(updates)
+    for commit in read_commits(args, GIT_PATH):
+        commit['refs'] = tracker.refs(commit['sha'], commit['parents'])
+        yield commit
+
+def handle_refs(updates, env, push):
+    """Handles the new commits of the (old, new, ref) updates of the checked
+    refs, each once, however many of the refs it was pushed to."""
+    if not updates:
+        return
 
-    # Get the subset of pending commits that are laready seen.
+    # Read the metadata of the commits in the changeset from a single git
+    # process, and handle them a chunk at a time, so a push of any number of
+    # commits takes the same amount of memory.
     db = env.get_db_cnx()
+    for pending_commits in chunks(timing.iterate('git', read_push_commits(updates))):
+        # Get the subset of pending commits that are not seen yet.
+        with timing.phase('seen'):
+            seen_commits = get_seen_commits(db, [commit['sha'] for commit in pending_commits])
+            pending_commits = [commit for commit in pending_commits
+                               if commit['sha'] not in seen_commits]
+
+            # Remember that have seen these commits, so each commit is only
+            # processed once. This is committed together with the ticket
+            # changes.
+            mark_seen(db, [commit['sha'] for commit in pending_commits])
+        timing.count('commits', len(pending_commits))
+
+        # A commit that cannot be handled is not marked as seen. Later pushes
+        # do not read it again, handle_push prints how to add it with
+        # --backfill once the error is fixed.
+        failed = []
+        for commit in pending_commits:
+            try:
+                 handle_commit(commit, env, push,
+                               ' '.join(sorted(commit['refs'])) or None)
+            except Exception, e:
+                 print 'Unexpected error while processing commit %s: %s' % (commit['sha'][:7], e)
+                 push.forget(commit)
+                 failed.append(commit['sha'])
+        if failed:
+            with timing.phase('seen'):
+                forget_seen(db, failed)
+            push.failed.extend(failed)
+
+        # Write the changes of this chunk, still without committing them.
+        with timing.phase('flush'):
+            push.flush(db)
+
+def backfill_command(args):
+    """Returns the command line adding the commits selected by the rev-list
+    arguments args with --backfill."""
+    return 'python %s --backfill %s' % (os.path.abspath(__file__),
+                                         ' '.join(args))
+
+def handle_push(lines, env, spool):
+    """Handles all ref updates of a push in a single transaction. When that
+    fails, or some commits fail, the --backfill command that adds them to
+    their tickets is printed, as later pushes do not read them again."""
+    db = env.get_db_cnx()
+    # Only the master branch, or whatever else is contained by the constant
+    # BRANCHES, is handled.
+    updates = ref_updates(lines, branch_patterns(BRANCHES))
+    for attempt in range(PUSH_ATTEMPTS):
+        push = PushTransaction(env, spool)
+        try:
+            handle_refs(updates, env, push)
+            handle_coalesced(env, push)
+            push.commit()
+            if push.failed:
+                print '%d commits were not added to their tickets. Once the ' \
+                      'error is fixed, add them as comments with:' % \
+                      len(push.failed)
+                print '  ' + backfill_command(['--no-walk'] + push.failed)
+            return
+        except db.IntegrityError, e:
+            # An other process has seen some of the pushed commits in the
+            # meantime, start over without them.
+            db.rollback()
+        except Exception, e:
+            db.rollback()
+            break
+    print 'Unexpected error while processing push, no tickets were updated: %s' % e
+    print 'Once the error is fixed, add the pushed commits as comments with:'
+    for old, new, ref in updates:
+        print '  ' + backfill_command([old == NULL_SHA and new or
+                                       '%s..%s' % (old, new)])
+
+def get_existing_tickets(db, tkt_ids):
+    """Returns the set of the ids in tkt_ids of tickets that exist."""
+    existing = set()
     cursor = db.cursor()
+    for chunk in chunks(sorted(tkt_ids)):
+        cursor.execute('SELECT id FROM ticket WHERE id IN (%s)'
+                       % ', '.join(['%s'] * len(chunk)), chunk)
+        existing.update([row[0] for row in cursor.fetchall()])
+    return existing
+
+def backfill(env, refs, args=None):
+    """Adds the commits of the checked refs, or those of them selected by the
+    rev-list arguments args, that this hook has not seen to the tickets they
+    reference, as comments dated at the commit, a transaction of
+    BACKFILL_BATCH_SIZE commits at a time. Returns the exit status."""
+    from trac.util.text import to_unicode
+    from trac.util.datefmt import utc
 
-    try:
-        cursor.execute('SELECT sha1 FROM git_seen WHERE sha1 IN (%s)'
-            % ', '.join(['%s'] * len(pending_commits)), pending_commits)
-        seen_commits = map(itemgetter(0), cursor.fetchall())
-    except db.OperationalError:
-        # almost definitely due to git_seen missing
-        cursor = db.cursor() # in case it was closed
-        cursor.execute('CREATE TABLE git_seen (sha1 TEXT)')
-        seen_commits = []
-
-    for commit in pending_commits:
-        # If the commit was seen yet, we must skip it.
-        if commit in seen_commits:
-             continue
-
-        # Remember that have seen this commit, so each commit is only processed once.
-        try:
-             cursor.execute('INSERT INTO git_seen (sha1) VALUES (%s)', [commit])
-        except db.IntegrityError:
-             # If an integrity error occurs (e.g. because of an other process has
-             # seen the script in the meantime), skip it too.
-             continue
+    if not refs:
+        print 'None of the BRANCHES exist, nothing to backfill'
+        return 1
+    # The commits selected by args that are on none of the refs are neither
+    # added nor marked as seen, so they are added when they are merged.
+    outside = set()
+    if args:
+        outside = set(call_git('rev-list', args + ['^' + ref for ref in refs]
+                               ).split())
+        if outside:
+            print 'Skipping %d commits that are on none of the BRANCHES' % \
+                len(outside)
+
+    db = env.get_db_cnx()
+    upgrade_git_seen(db)
+    upgrade_commit_index(db)
+    # No notifications are spooled for the old commits.
+    push = PushTransaction(env, None)
+    push.times = BackfillTimeAllocator()
+    tickets = {}
+
+    start = time.time()
+    read = new = comments = 0
+    # Oldest first, so the comments are numbered in the order of the commits.
+    for commits in chunks(read_commits(['--reverse'] + (args or refs),
+                                       GIT_PATH),
+                          BACKFILL_BATCH_SIZE):
+        commits = [commit for commit in commits
+                   if commit['sha'] not in outside]
+        read += len(commits)
+        seen_commits = get_seen_commits(db, [commit['sha'] for commit in commits])
+        commits = [commit for commit in commits
+                   if commit['sha'] not in seen_commits]
+        new += len(commits)
+        mark_seen(db, [commit['sha'] for commit in commits])
+
+        references = []
+        for commit in commits:
+            commit_refs = commit_tickets(commit)[0]
+            push.reference(commit, commit_refs)
+            tkt_ids = set([int(tkt_id) for tkt_id in commit_refs])
+            if tkt_ids:
+                references.append((commit, sorted(tkt_ids)))
+        unknown = set([tkt_id for commit, tkt_ids in references
+                       for tkt_id in tkt_ids if tkt_id not in tickets])
+        existing = get_existing_tickets(db, unknown)
+        for tkt_id in unknown:
+            tickets[tkt_id] = tkt_id in existing
+
+        for commit, tkt_ids in references:
+            when = datetime.fromtimestamp(commit['time'], utc)
+            for tkt_id in tkt_ids:
+                if not tickets[tkt_id]:
+                    continue
+                push.save_ticket_change(tkt_id, to_unicode(commit['email']),
+                                        push.times.allocate(tkt_id, when, db),
+                                        'comment',
+                                        str(push.next_cnum(tkt_id, db)),
+                                        to_unicode(commit['msg']))
+                comments += 1
 
         try:
-             handle_commit(commit, env)
-        except Exception, e:
-             print 'Unexpected error while processing commit %s: %s' % (commit[:7], e)
-             db.rollback()
-        else:
-             db.commit()
+            push.commit()
+        except db.IntegrityError, e:
+            db.rollback()
+            print 'Some commits were pushed while backfilling, run it again: %s' % e
+            return 1
+        elapsed = time.time() - start
+        print '%d commits read, %d new, %d comments added, %.0f commits/s' % (
+            read, new, comments, read / max(elapsed, 1e-6))
+    return 0
+
+def main(env, lines):
+    """Handles the push of the ref update lines, returns the exit status."""
+    timing.start('post-receive', TIMING_LOG, PROFILE_LOG)
+    timing.count('refs', len(lines))
+    try:
+        with timing.phase('upgrade'):
+            upgrade_git_seen(env.get_db_cnx())
+            upgrade_commit_index(env.get_db_cnx())
+            spool = NotifySpool(env.path)
 
-if __name__ == '__main__':
-    from trac.env import open_environment
-    env = open_environment(TRAC_ENV)
+        handle_push(lines, env, spool)
 
-    for line in sys.stdin:
-        handle_ref(env=env, *line.split())
+        if SPAWN_NOTIFY_WORKER and spool.pending():
+            with timing.phase('worker'):
+                spawn_worker(env.path)
+    finally:
+        timing.finish(0)
+    return 0
 
+if __name__ == '__main__':
+    from trac_hook_daemon import run_in_daemon
+
+    if sys.argv[1:2] == ['--backfill']:
+        from trac.env import open_environment
+        patterns = branch_patterns(BRANCHES)
+        refs = call_git('for-each-ref', ['--format=%(refname)', 'refs/heads/'])
+        refs = [ref for ref in refs.splitlines()
+                if is_checked_ref(ref, patterns)]
+        sys.exit(backfill(open_environment(TRAC_ENV), refs, sys.argv[2:]))
+
+    lines = sys.stdin.readlines()
+    status = run_in_daemon(TRAC_ENV, __file__, lines)
+    if status is None:
+        # No daemon running, so do it ourselves.
+        from trac.env import open_environment
+        timing.start('post-receive', TIMING_LOG, PROFILE_LOG)
+        with timing.phase('env'):
+            env = open_environment(TRAC_ENV)
+        status = main(env, lines)
+    sys.exit(status)
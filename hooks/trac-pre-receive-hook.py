@@ -68,7 +68,10 @@
 #was detected in the pushed refs.
 #
 #This can be used to force the usage of commands and ticket numbers in git
-#pushes.
+#pushes. All pushed commits are checked before the hook exits, so every
+#offending commit and ticket is reported at once. Commits that are already on
+#one of the checked branches, or that passed the checks before, are not
+#checked again.
 #
 #To make things more user friendly a pre-commit hook like this can be isntalled
 #in each users local repository:
@@ -100,10 +103,18 @@
 import sys
 import os
 import re
+import hashlib
 from subprocess import Popen, PIPE
+from trac_commit_parser import parse_message, ticket_command
+from trac_hook_timing import timing
+from trac_git_log import read_commits, chunks
+from trac_push_refs import branch_patterns, is_checked_ref, ref_updates, push_args
 
 TRAC_ENV = '/home/dev/trac/core'
 GIT_PATH = '/usr/bin/git'
+# Branches handled by this hook: names, glob patterns like 'release/*' or
+# compiled regular expressions like re.compile(r'feature/[0-9]+'), see
+# trac_push_refs.py.
 BRANCHES = ['master']
 COMMANDS = {
 		'close':      	intern('close'),
@@ -126,75 +137,207 @@ ACCEPTED_STATUSSES = ['accepted','assigned']
 if not 'PYTHON_EGG_CACHE' in os.environ:
     os.environ['PYTHON_EGG_CACHE'] = '/tmp/.egg-cache'
 
-# Construct and compile regular expressions for finding ticket references and
-# actions in commit messages.
-ticket_prefix = '(?:#|(?:ticket|issue|bug)[: ]?)'
-ticket_reference = ticket_prefix + '[0-9]+'
-ticket_command =  (r'(?P<action>[A-Za-z]*).?'
-                   '(?P<ticket>%s(?:(?:[, &]*|[ ]?and[ ]?)%s)*)' %
-                   (ticket_reference, ticket_reference))
-command_re = re.compile(ticket_command)
-ticket_re = re.compile(ticket_prefix + '([0-9]+)')
+# Commits that passed the checks are remembered in git_validated together with
+# a hash of everything the checks depend on, so they are not checked again
+# unless this configuration changes.
+VALIDATION_CONFIG = hashlib.sha1(repr((sorted(COMMANDS.items()),
+                                       sorted(ACCEPTED_STATUSSES),
+                                       ticket_command))).hexdigest()
+GIT_VALIDATED_VERSION = 1
+
+# Append a record with the time spent in each phase of every push to this
+# file, e.g. os.path.join(TRAC_ENV, 'log', 'pre-receive-timing.log'), and
+# with PROFILE_LOG a cProfile report as well. See trac_hook_timing.py.
+TIMING_LOG = None
+PROFILE_LOG = None
 
 def call_git(command, args):
     return Popen([GIT_PATH, command] + args, stdout=PIPE).communicate()[0]
 
-def handle_commit(commit, env):
-    from trac.ticket import Ticket
-    from trac.ticket.web_ui import TicketModule
-    from trac.util.text import to_unicode
-    from trac.util.datefmt import utc
-
-    msg = to_unicode(call_git('rev-list', ['-n', '1', commit, '--pretty=medium']).rstrip())
-    eml = to_unicode(call_git('rev-list', ['-n', '1', commit, '--pretty=format:%ae']).splitlines()[1])
-
-    tickets = {}
-    comtkts = command_re.findall(msg.split('\n\n', 1)[1])
-    if not comtkts:
-         print "no 'refs' or 'closes' in commitmessage for commit %s, aborting push" % commit
-	 sys.exit(1)
-    for cmd, tkts in comtkts:
-        action = COMMANDS.get(cmd.lower())
-        if action:
-            for tkt_id in ticket_re.findall(tkts):
-                tickets.setdefault(tkt_id, []).append(action)
-	else: #no action specified, bad commit message!
-	    print "no 'refs' or 'closes' in commitmessage for commit %s, aborting push" % commit
-	    sys.exit(1)
-	
-    for tkt_id, actions in tickets.iteritems():
-        try:
-            db = env.get_db_cnx()
-            ticket = Ticket(env, int(tkt_id), db)
-	    if not ticket['status'] in ACCEPTED_STATUSSES:
-		print "commiting to non-open ticket in commit %s, aborting push" % commit
-		sys.exit(2)
-
-        except Exception, e:
-            print 'Unexpected error while processing commit %s :' % commit
-	    print 'ticket ID %s: %s' % (tkt_id, e)
-	    sys.exit(3)
-
-def handle_ref(old, new, ref, env):
-    # If something else than the master branch (or whatever is contained by the
-    # constant BRANCHES) was pushed, skip this ref.
-    if not ref.startswith('refs/heads/') or ref[11:] not in BRANCHES:
+def is_checked_branch(ref):
+    return is_checked_ref(ref, branch_patterns(BRANCHES))
+
+def get_checked_branches():
+    """Returns the existing refs of the branches checked by this hook."""
+    refs = call_git('for-each-ref', ['--format=%(refname)', 'refs/heads/'])
+    return [ref for ref in refs.splitlines() if is_checked_branch(ref)]
+
+def upgrade_git_validated(db):
+    """Creates the git_validated table, and records its version in Trac's
+    system table."""
+    cursor = db.cursor()
+    cursor.execute("SELECT value FROM system WHERE name='git_validated_version'")
+    row = cursor.fetchone()
+    if row and int(row[0]) >= GIT_VALIDATED_VERSION:
+        return
+    cursor.execute('CREATE TABLE git_validated (sha1 VARCHAR(40), '
+                   'config VARCHAR(40), PRIMARY KEY (sha1, config))')
+    cursor.execute("INSERT INTO system (name, value) "
+                   "VALUES ('git_validated_version', %s)",
+                   (str(GIT_VALIDATED_VERSION),))
+    db.commit()
+
+def get_validated_commits(db, shas):
+    """Returns the set of shas that passed the checks with the current
+    configuration before."""
+    validated = set()
+    cursor = db.cursor()
+    for chunk in chunks(shas):
+        cursor.execute('SELECT sha1 FROM git_validated WHERE config=%%s '
+                       'AND sha1 IN (%s)' % ', '.join(['%s'] * len(chunk)),
+                       [VALIDATION_CONFIG] + chunk)
+        validated.update(row[0] for row in cursor.fetchall())
+    return validated
+
+def mark_validated(db, shas):
+    """Records that shas passed the checks, committing every chunk. The shas
+    an other push validated in the meantime are skipped; as this is only a
+    cache, a chunk that still fails is left out rather than failing the
+    push."""
+    for chunk in chunks(shas):
+        for attempt in xrange(2):
+            try:
+                db.cursor().executemany('INSERT INTO git_validated '
+                                        '(sha1, config) VALUES (%s, %s)',
+                                        [(sha, VALIDATION_CONFIG)
+                                         for sha in chunk])
+                db.commit()
+                break
+            except db.IntegrityError:
+                db.rollback()
+                validated = get_validated_commits(db, chunk)
+                chunk = [sha for sha in chunk if sha not in validated]
+
+def parse_tickets(commit):
+    """Returns the ids of the tickets referenced by commit, or None if its
+    message has no command, or an unknown one."""
+    commands, hours = parse_message(commit['msg'].split('\n\n', 1)[1])
+    if not commands:
+        return None
+    tickets = []
+    for cmd, tkt_ids in commands:
+        if not COMMANDS.get(cmd.lower()):
+            return None
+        tickets.extend([int(tkt_id) for tkt_id in tkt_ids])
+    return tickets
+
+def get_ticket_statusses(db, tkt_ids):
+    """Returns a dict with the status of each existing ticket in tkt_ids."""
+    statusses = {}
+    cursor = db.cursor()
+    for chunk in chunks(sorted(tkt_ids)):
+        cursor.execute('SELECT id, status FROM ticket WHERE id IN (%s)'
+                       % ', '.join(['%s'] * len(chunk)), chunk)
+        statusses.update(cursor.fetchall())
+    return statusses
+
+def push_commits(lines, exclude):
+    """Yields the pending commits of all checked refs of the ref update lines
+    of a push that are not reachable from any of the refs in exclude."""
+    # Refs that are not a checked branch, the master branch or whatever else
+    # is contained by the constant BRANCHES, are skipped. Commits that are
+    # already on a checked branch have been accepted before, so only the
+    # commits that are new to all of them are read, for all refs in one go.
+    updates = ref_updates(lines, branch_patterns(BRANCHES))
+    if not updates:
         return
+    for commit in read_commits(push_args(updates, exclude), GIT_PATH):
+        yield commit
+
+def check_push(lines, env):
+    """Checks all new commits of a push, a chunk of commits at a time so any
+    number of commits can be checked in the same amount of memory, looking up
+    the status of each referenced ticket once. Returns a list of (exit code,
+    message) problems."""
+    db = env.get_db_cnx()
+    with timing.phase('upgrade'):
+        upgrade_git_validated(db)
+    with timing.phase('git'):
+        exclude = get_checked_branches()
+
+    problems = []
+    statusses = {}
+    bad_commits = set()
+    for commits in chunks(timing.iterate('git', push_commits(lines, exclude))):
+        with timing.phase('validated'):
+            validated = get_validated_commits(db, [commit['sha'] for commit in commits])
+        timing.count('commits', len(commits))
+        references = {}
+        checked = []
+        for commit in commits:
+            sha = commit['sha']
+            # A commit on more than one pushed ref is read only once, and
+            # skipped if it was accepted before.
+            if sha in validated or sha in bad_commits:
+                continue
+            validated.add(sha)
+            checked.append(sha)
+            with timing.phase('parse'):
+                tickets = parse_tickets(commit)
+            if tickets is None:
+                problems.append((1, "no 'refs' or 'closes' in commitmessage for commit %s" % sha))
+                bad_commits.add(sha)
+                continue
+            for tkt_id in tickets:
+                references.setdefault(tkt_id, []).append(sha)
+
+        unknown = [tkt_id for tkt_id in references if tkt_id not in statusses]
+        with timing.phase('status'):
+            found = get_ticket_statusses(db, unknown)
+        for tkt_id in unknown:
+            statusses[tkt_id] = found.get(tkt_id)
+        for tkt_id, shas in sorted(references.iteritems()):
+            status = statusses[tkt_id]
+            for sha in shas:
+                if status is None:
+                    problems.append((3, 'ticket #%s does not exist, in commit %s' % (tkt_id, sha)))
+                    bad_commits.add(sha)
+                elif not status in ACCEPTED_STATUSSES:
+                    problems.append((2, 'commiting to non-open ticket #%s (%s) in commit %s' % (tkt_id, status, sha)))
+                    bad_commits.add(sha)
+
+        with timing.phase('commit'):
+            mark_validated(db, [sha for sha in checked if sha not in bad_commits])
+    timing.count('problems', len(problems))
+    return problems
+
+def main(env, lines):
+    """Checks the push of the ref update lines, returns the exit status."""
+    timing.start('pre-receive', TIMING_LOG, PROFILE_LOG)
+    timing.count('refs', len(lines))
+    status = 4
+    try:
+        status = check(env, lines)
+    finally:
+        timing.finish(status)
+    return status
 
-    # Get the list of hashs for commits in the changeset.
-    args = (old == '0' * 40) and [new] or [new, '^' + old]
-    pending_commits = call_git('rev-list', args).splitlines()
+def check(env, lines):
+    try:
+        problems = check_push(lines, env)
+    except Exception, e:
+        print 'Unexpected error while checking push: %s' % e
+        return 4
 
-    for commit in pending_commits:
-        try:
-             handle_commit(commit, env)
-        except Exception, e:
-             print  'Unexpected error while processing commit %s: %s' % (commit[:7], e)
-             sys.exit(4)
+    # Report every problem at once, so they can all be fixed before pushing
+    # again, and exit with the code of the most basic one.
+    for code, message in problems:
+        print message
+    if problems:
+        print '%d problem(s) found, aborting push' % len(problems)
+        return min([code for code, message in problems])
+    return 0
 
 if __name__ == '__main__':
-    from trac.env import open_environment
-    env = open_environment(TRAC_ENV)
+    from trac_hook_daemon import run_in_daemon
 
-    for line in sys.stdin:
-        handle_ref(env=env, *line.split())
+    lines = sys.stdin.readlines()
+    status = run_in_daemon(TRAC_ENV, __file__, lines)
+    if status is None:
+        # No daemon running, so do it ourselves.
+        from trac.env import open_environment
+        timing.start('pre-receive', TIMING_LOG, PROFILE_LOG)
+        with timing.phase('env'):
+            env = open_environment(TRAC_ENV)
+        status = main(env, lines)
+    sys.exit(status)
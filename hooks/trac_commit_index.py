@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# trac_commit_index
+# ----------------------------------------------------------------------------
+# Copyright (c) 2012 Jens Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+# ----------------------------------------------------------------------------
+
+# Index of the ticket references in commit messages.
+#
+# trac-post-receive-hook.py (also with --backfill) and convertTracTickets.py
+# --index write a row for every ticket a commit references to the
+# git_ticket_commit table of the Trac database: the sha of the commit, the
+# ticket id, the action (close or refs), the author, the commit time (unix
+# timestamp) and the refs it was pushed to, separated by spaces, if known. This
+# script answers questions from that table, without searching the ticket
+# comments:
+#
+#   python trac_commit_index.py /path/to/trac/env ticket 123
+#     lists the commits referencing ticket 123
+#   python trac_commit_index.py /path/to/trac/env range v1.0..v1.1 [action]
+#     lists the tickets referenced by the commits in a range, run inside the
+#     repository; give an action (e.g. close) to list only those tickets
+#
+# Keep this file next to the hooks.
+
+import sys
+import os
+from subprocess import Popen, PIPE
+from trac_git_log import chunks
+
+GIT_PATH = 'git'
+INDEX_VERSION = 1
+COLUMNS = ('sha1', 'ticket', 'action', 'author', 'time', 'ref')
+
+# Use the egg cache of the environment if not other python egg cache is given.
+if not 'PYTHON_EGG_CACHE' in os.environ:
+    os.environ['PYTHON_EGG_CACHE'] = '/tmp/.egg-cache'
+
+
+def upgrade_commit_index(db):
+    """Creates the git_ticket_commit table, and records its version in Trac's
+    system table."""
+    cursor = db.cursor()
+    cursor.execute("SELECT value FROM system "
+                   "WHERE name='git_ticket_commit_version'")
+    row = cursor.fetchone()
+    if row and int(row[0]) >= INDEX_VERSION:
+        return
+    cursor.execute('CREATE TABLE git_ticket_commit (sha1 VARCHAR(40), '
+                   'ticket INTEGER, action VARCHAR(16), author TEXT, '
+                   'time INTEGER, ref TEXT, '
+                   'PRIMARY KEY (sha1, ticket, action))')
+    cursor.execute('CREATE INDEX git_ticket_commit_ticket_idx '
+                   'ON git_ticket_commit (ticket)')
+    cursor.execute("INSERT INTO system (name, value) "
+                   "VALUES ('git_ticket_commit_version', %s)",
+                   (str(INDEX_VERSION),))
+    db.commit()
+
+
+def add_references(db, rows):
+    """Writes rows of COLUMNS values, without committing. The earlier rows of
+    the same commits and tickets are replaced, so adding a commit again does
+    no harm."""
+    rows = dict([((row[0], row[1], row[2]), row) for row in rows])
+    cursor = db.cursor()
+    # All earlier rows are deleted before any row is inserted, as the rows of
+    # one commit and ticket may end up in different chunks.
+    for chunk in chunks(sorted(set([key[:2] for key in rows]))):
+        cursor.executemany('DELETE FROM git_ticket_commit '
+                           'WHERE sha1=%s AND ticket=%s', chunk)
+    for chunk in chunks(sorted(rows)):
+        cursor.executemany('INSERT INTO git_ticket_commit (%s) VALUES (%s)' %
+                           (', '.join(COLUMNS), ', '.join(['%s'] * len(COLUMNS))),
+                           [rows[key] for key in chunk])
+
+
+def ticket_commits(db, tkt_id):
+    """Returns the (sha, action, author, time, ref) of the commits referencing
+    ticket tkt_id, oldest first."""
+    cursor = db.cursor()
+    cursor.execute('SELECT sha1, action, author, time, ref '
+                   'FROM git_ticket_commit WHERE ticket=%s '
+                   'ORDER BY time, sha1', (int(tkt_id),))
+    return cursor.fetchall()
+
+
+def commit_tickets(db, shas):
+    """Yields the (sha, ticket, action) references of the commits shas, which
+    may be any iterable, a chunk at a time."""
+    cursor = db.cursor()
+    for chunk in chunks(shas):
+        cursor.execute('SELECT sha1, ticket, action FROM git_ticket_commit '
+                       'WHERE sha1 IN (%s)' % ', '.join(['%s'] * len(chunk)),
+                       chunk)
+        for row in cursor.fetchall():
+            yield row
+
+
+def rev_list(args):
+    """Yields the shas of the commits selected by the rev-list arguments
+    args."""
+    proc = Popen([GIT_PATH, 'rev-list'] + args, stdout=PIPE)
+    try:
+        for line in proc.stdout:
+            yield line.strip()
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def range_tickets(db, args, action=None):
+    """Returns a dict with the shas of the commits referencing each ticket,
+    of the commits selected by the rev-list arguments args, and only for
+    action if it is given."""
+    tickets = {}
+    for sha, tkt_id, tkt_action in commit_tickets(db, rev_list(args)):
+        if action is None or tkt_action == action:
+            tickets.setdefault(tkt_id, []).append(sha)
+    return tickets
+
+
+if __name__ == '__main__':
+    from datetime import datetime
+    from trac.env import open_environment
+
+    args = sys.argv[1:]
+    if len(args) == 3 and args[1] == 'ticket':
+        db = open_environment(args[0]).get_db_cnx()
+        for sha, action, author, time, ref in ticket_commits(db, args[2]):
+            print '%s %-5s %s %s %s' % (
+                sha, action, datetime.utcfromtimestamp(time).strftime(
+                    '%Y-%m-%d %H:%M:%S'), author, ref or '')
+    elif len(args) in (3, 4) and args[1] == 'range':
+        db = open_environment(args[0]).get_db_cnx()
+        tickets = range_tickets(db, [args[2]], (args[3:] or [None])[0])
+        for tkt_id, shas in sorted(tickets.iteritems()):
+            print '#%s %s' % (tkt_id, ' '.join(shas))
+    else:
+        print 'Usage: %s /path/to/trac/env ticket ID' % sys.argv[0]
+        print '       %s /path/to/trac/env range RANGE [ACTION]' % sys.argv[0]
+        sys.exit(1)
@@ -0,0 +1,154 @@
+# trac_commit_parser
+# ----------------------------------------------------------------------------
+# Copyright (c) 2012 Jens Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+# ----------------------------------------------------------------------------
+
+# Commit message parser shared by trac-pre-receive-hook.py and
+# trac-post-receive-hook.py. Keep this file next to the hooks.
+#
+# The commands and worked hours in a commit message used to be found with
+# command_re and hours_re below. command_re nests optional repetitions, which
+# makes it backtrack heavily on long messages. parse_message finds exactly the
+# same commands and hours in one pass over the message, in time linear in its
+# length: every position is looked at a bounded number of times, and the
+# regular expressions it uses match single runs of characters only.
+
+import re
+
+# Construct regular expressions for finding ticket references and actions in
+# commit messages. These define the syntax parse_message implements.
+ticket_prefix = '(?:#|(?:ticket|issue|bug)[: ]?)'
+ticket_reference = ticket_prefix + '[0-9]+'
+ticket_command =  (r'(?P<action>[A-Za-z]*).?'
+                   '(?P<ticket>%s(?:(?:[, &]*|[ ]?and[ ]?)%s)*)' %
+                   (ticket_reference, ticket_reference))
+command_re = re.compile(ticket_command)
+ticket_re = re.compile(ticket_prefix + '([0-9]+)')
+hours_re = re.compile("worked\s*(?P<hours>[0-9.]+)h")
+
+TICKET_WORDS = ('ticket', 'issue', 'bug')
+
+_letters = re.compile('[A-Za-z]*')
+_digits = re.compile('[0-9]*')
+_separators = re.compile('[, &]*')
+_spaces = re.compile('\s*')
+_number = re.compile('[0-9.]*')
+_reference_start = re.compile('[A-Za-z#]')
+
+
+def _ticket_at(text, pos):
+    """Returns the (start, end) of the ticket number of the ticket reference
+    at pos, or None if there is none."""
+    if text.startswith('#', pos):
+        start = pos + 1
+    else:
+        for word in TICKET_WORDS:
+            if text.startswith(word, pos):
+                start = pos + len(word)
+                break
+        else:
+            return None
+        if text[start:start + 1] in (':', ' ') and \
+           '0' <= text[start + 1:start + 2] <= '9':
+            start += 1
+    end = _digits.match(text, start).end()
+    if end == start:
+        return None
+    return start, end
+
+
+def _next_ticket_at(text, pos):
+    """Returns the (start, end) of the ticket number of the ticket reference
+    following a separator at pos, or None if there is none."""
+    ticket = _ticket_at(text, _separators.match(text, pos).end())
+    if ticket:
+        return ticket
+    for start in text.startswith(' ', pos) and (pos + 1, pos) or (pos,):
+        if text.startswith('and', start):
+            end = start + 3
+            for ref in text.startswith(' ', end) and (end + 1, end) or (end,):
+                ticket = _ticket_at(text, ref)
+                if ticket:
+                    return ticket
+    return None
+
+
+def _command_at(text, pos, end):
+    """Returns the position of the first ticket reference of the command
+    starting at pos, whose action word ends at end, or None if no command
+    starts at pos."""
+    # The character after the action word may be skipped...
+    if end < len(text) and text[end] != '\n' and _ticket_at(text, end + 1):
+        return end + 1
+    # ...otherwise the reference directly follows the action word, or is the
+    # tail of it, like the 'bug' in 'debug12'.
+    for ref in [end] + [end - len(word) for word in TICKET_WORDS]:
+        if ref >= pos and _ticket_at(text, ref):
+            return ref
+    return None
+
+
+def parse_message(text):
+    """Finds the commands and worked hours in the commit message text.
+
+    Returns a list of (action, ticket ids) pairs, where ticket ids is a list
+    of strings, and the list of worked hours strings. These are the same as
+    [(action, ticket_re.findall(tickets)) for action, tickets in
+    command_re.findall(text)] and hours_re.findall(text).
+    """
+    commands = []
+    hours = []
+    hours_end = 0
+    pos = 0
+    while pos < len(text):
+        end = _letters.match(text, pos).end()
+
+        # Worked hours always follow a word ending in 'worked'.
+        if end - 6 >= max(pos, hours_end) and text.startswith('worked', end - 6):
+            start = _spaces.match(text, end).end()
+            number_end = _number.match(text, start).end()
+            if number_end > start and text.startswith('h', number_end):
+                hours.append(text[start:number_end])
+                hours_end = number_end + 1
+
+        ref = _command_at(text, pos, end)
+        if ref is None:
+            if end > pos:
+                pos = end
+                continue
+            # Anything else than a letter or '#' can only start a command when
+            # it directly precedes one, so skip ahead to the next of those.
+            match = _reference_start.search(text, pos + 1)
+            if not match:
+                break
+            pos = max(pos + 1, match.start() - 1)
+            continue
+
+        start, ticket_end = _ticket_at(text, ref)
+        tickets = [text[start:ticket_end]]
+        ticket = _next_ticket_at(text, ticket_end)
+        while ticket:
+            start, ticket_end = ticket
+            tickets.append(text[start:ticket_end])
+            ticket = _next_ticket_at(text, ticket_end)
+        commands.append((text[pos:min(ref, end)], tickets))
+        pos = ticket_end
+    return commands, hours
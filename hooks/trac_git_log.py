@@ -0,0 +1,101 @@
+# trac_git_log
+# ----------------------------------------------------------------------------
+# Copyright (c) 2012 Jens Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+# ----------------------------------------------------------------------------
+
+# Reading of the pushed commits, shared by trac-pre-receive-hook.py,
+# trac-post-receive-hook.py and trac_commit_index.py. Keep this file next to
+# the hooks.
+#
+# The metadata of all commits of a push is read through a single git log
+# process and parsed as it streams in, and handled a chunk at a time, so a
+# push of any number of commits takes the same amount of memory.
+
+from itertools import islice
+from subprocess import Popen, PIPE
+
+# Maximum number of values bound in one query, safely below the limit of 999
+# host parameters of SQLite.
+SQL_CHUNK_SIZE = 500
+
+# Fields of the git log format used to read the metadata of all pending
+# commits through a single git process. Fields are separated by the ASCII unit
+# separator and, with -z, records by a NUL byte, neither of which can occur in
+# a hash, an email address or a (sane) commit message.
+LOG_FORMAT = '%x1f'.join(['%H', '%p', '%P', '%an', '%ae', '%ad', '%at', '%B'])
+
+
+def read_records(stream, separator='\0', bufsize=65536):
+    """Yields the separator terminated records read from stream."""
+    pending = ''
+    while True:
+        data = stream.read(bufsize)
+        if not data:
+            break
+        records = (pending + data).split(separator)
+        pending = records.pop()
+        for record in records:
+            yield record
+    if pending:
+        yield pending
+
+
+def parse_commit(record):
+    """Parses one LOG_FORMAT record into a dict with the sha, the full hashes
+    of the parents, author email, author date (unix timestamp) and the message
+    formatted the way 'git rev-list --pretty=medium' would print it."""
+    (sha, parents, full_parents, name, email, date, timestamp,
+     body) = record.split('\x1f', 7)
+    header = ['commit %s' % sha]
+    if ' ' in parents:
+        header.append('Merge: %s' % parents)
+    header.append('Author: %s <%s>' % (name, email))
+    header.append('Date:   %s' % date)
+    lines = ['    ' + line for line in body.rstrip('\n').split('\n')]
+    return {'sha': sha,
+            'parents': full_parents.split(),
+            'email': email,
+            'time': int(timestamp),
+            'msg': '\n'.join(header) + '\n\n' + '\n'.join(lines)}
+
+
+def read_commits(args, git_path='git'):
+    """Yields the parsed metadata of every commit selected by the rev-list
+    arguments args, using one git log process for all of them."""
+    proc = Popen([git_path, 'log', '-z', '--format=' + LOG_FORMAT] + args,
+                 stdout=PIPE)
+    try:
+        for record in read_records(proc.stdout):
+            yield parse_commit(record)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def chunks(items, size=SQL_CHUNK_SIZE):
+    """Splits the iterable items into lists of at most size items, reading
+    only one list ahead."""
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
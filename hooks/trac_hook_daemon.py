@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# trac_hook_daemon
+# ----------------------------------------------------------------------------
+# Copyright (c) 2012 Jens Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+# ----------------------------------------------------------------------------
+
+# Optional daemon that keeps the Trac environment open for the trac hooks.
+#
+# Opening the Trac environment and loading its plugins takes seconds, and
+# used to be done again by every hook run. When this daemon is running, the
+# hooks pass the ref updates they read on stdin to it over a Unix domain
+# socket, and only print the messages and exit with the status it sends back.
+# When it is not running the hooks do all the work themselves, as before. Once
+# the daemon has accepted a push the hook waits for it however long the push
+# takes, and reports a failure if the daemon dies, without handling the push
+# a second time.
+#
+# Start it as the user the hooks run as, with the Trac environment and the
+# hooks it may run:
+#
+#   python trac_hook_daemon.py /path/to/trac/env \
+#       /path/to/repo.git/hooks/pre-receive /path/to/repo.git/hooks/post-receive
+#
+# The socket is created in the db directory of the Trac environment. Requests
+# are handled one at a time, so a push never waits on more than one other
+# push. Keep this file next to the hooks.
+
+import sys
+import os
+import imp
+import json
+import signal
+import socket
+import traceback
+
+SOCKET_NAME = 'hook-daemon.sock'
+# Seconds a hook waits for the daemon to accept its push before handling the
+# push itself. There is no limit on handling it, which can take long for the
+# first push of a large repository.
+CONNECT_TIMEOUT = 5
+
+# Environment variables of the hook that git commands run by the daemon need
+# to see, e.g. to find the quarantined objects of a push in pre-receive.
+GIT_VARIABLES = ('GIT_DIR', 'GIT_OBJECT_DIRECTORY',
+                 'GIT_ALTERNATE_OBJECT_DIRECTORIES', 'GIT_QUARANTINE_PATH')
+
+# Use the egg cache of the environment if not other python egg cache is given.
+if not 'PYTHON_EGG_CACHE' in os.environ:
+    os.environ['PYTHON_EGG_CACHE'] = '/tmp/.egg-cache'
+
+
+def socket_path(env_path):
+    return os.path.join(env_path, 'db', SOCKET_NAME)
+
+
+def receive_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return ''.join(chunks)
+        chunks.append(data)
+
+
+def run_in_daemon(env_path, hook, lines):
+    """Lets the daemon of env_path run hook, the path of the calling hook
+    script, on the ref update lines. Prints the output of the hook and returns
+    its exit status, or None if no daemon is running or it does not run hook,
+    so the hook has to do the work itself. If the daemon fails after it
+    accepted the push, the hook may already have changed the Trac database,
+    so that is reported with exit status 1 instead."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(socket_path(env_path))
+        except socket.error:
+            return None
+        request = {'hook': os.path.realpath(hook),
+                   'cwd': os.getcwd(),
+                   'env': dict([(name, os.environ[name])
+                                for name in GIT_VARIABLES
+                                if name in os.environ]),
+                   'stdin': lines}
+        sock.settimeout(None)
+        try:
+            sock.sendall(json.dumps(request))
+            sock.shutdown(socket.SHUT_WR)
+            response = receive_all(sock)
+        except socket.error, e:
+            response = None
+            print 'The hook daemon failed: %s' % e
+    finally:
+        sock.close()
+    if not response:
+        # The daemon died while handling the push.
+        print 'The hook daemon did not finish the push, see its output.'
+        return 1
+    response = json.loads(response)
+    if response['status'] is None:
+        # The daemon was started without this hook.
+        return None
+    sys.stdout.write(response['output'].encode('utf-8'))
+    return response['status']
+
+
+class Output(object):
+    """Collects everything a hook prints."""
+
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.data.append(data)
+
+    def getvalue(self):
+        return ''.join(self.data).decode('utf-8', 'replace')
+
+
+class HookDaemon(object):
+    """Runs the hooks given by path for the Trac environment env_path."""
+
+    def __init__(self, env_path, hooks):
+        self.env_path = env_path
+        self.hooks = {}
+        for i, path in enumerate(hooks):
+            path = os.path.realpath(path)
+            if os.path.dirname(path) not in sys.path:
+                sys.path.insert(0, os.path.dirname(path))
+            self.hooks[path] = imp.load_source('trac_hook_%d' % i, path)
+
+    def handle(self, request):
+        """Runs the hook of request, returns its exit status and output. The
+        status is None when this daemon does not serve the hook."""
+        from trac.env import open_environment
+
+        hook = self.hooks.get(request['hook'])
+        if hook is None:
+            return None, u'%s is not served by this daemon\n' % request['hook']
+
+        for name in GIT_VARIABLES:
+            os.environ.pop(name, None)
+        os.environ.update(request['env'])
+        os.chdir(request['cwd'])
+
+        output = Output()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            try:
+                # The environment is cached, and reloaded when trac.ini changes.
+                env = open_environment(self.env_path, use_cache=True)
+                status = hook.main(env, request['stdin'])
+            except SystemExit, e:
+                status = e.code
+            except Exception:
+                traceback.print_exc(file=output)
+                status = 1
+        finally:
+            sys.stdout = stdout
+        return status or 0, output.getvalue()
+
+    def serve(self):
+        path = socket_path(self.env_path)
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0117)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        try:
+            while True:
+                conn, address = server.accept()
+                try:
+                    request = json.loads(receive_all(conn))
+                    status, output = self.handle(request)
+                    conn.sendall(json.dumps({'status': status,
+                                             'output': output}))
+                except Exception:
+                    traceback.print_exc()
+                conn.close()
+        finally:
+            server.close()
+            os.unlink(path)
+
+
+def terminate(signum, frame):
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print 'Usage: %s /path/to/trac/env hook [hook ...]' % sys.argv[0]
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, terminate)
+    HookDaemon(sys.argv[1], sys.argv[2:]).serve()
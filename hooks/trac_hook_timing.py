@@ -0,0 +1,165 @@
+# trac_hook_timing
+# ----------------------------------------------------------------------------
+# Copyright (c) 2012 Jens Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+# ----------------------------------------------------------------------------
+
+# Timing of the phases of a push, shared by trac-pre-receive-hook.py and
+# trac-post-receive-hook.py. Keep this file next to the hooks.
+#
+# The hooks wrap every phase of a push (reading commits from git, queries,
+# ticket updates, the commit, spooling notifications) in timing.phase(name).
+# When TIMING_LOG is set in a hook, the number of times each phase ran and
+# the time spent in it are appended to that file as one JSON record per push:
+#
+#   {"hook": "post-receive", "start": "2012-06-01T12:00:00", "status": 0,
+#    "seconds": 1.52, "counts": {"commits": 3, ...},
+#    "phases": {"git": [4, 0.031], "ticket": [3, 0.84], ...}}
+#
+# When PROFILE_LOG is set as well, a cProfile report of every push is
+# appended to it. When TIMING_LOG is not set, timing.phase returns one shared
+# no-op context manager, so the instrumentation costs next to nothing.
+
+import os
+import time
+import json
+from datetime import datetime
+
+
+class NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_PHASE = NullPhase()
+
+
+class Phase(object):
+
+    def __init__(self, timing, name):
+        self.timing = timing
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timing.add(self.name, time.time() - self.start)
+        return False
+
+
+class Timing(object):
+    """Counts and cumulative times of the phases of the push being handled."""
+
+    def __init__(self):
+        self.enabled = False
+
+    def start(self, hook, log_path, profile_path=None):
+        """Starts timing a push of hook, unless timing is disabled by a log_path
+        of None or it was started already."""
+        if self.enabled or log_path is None:
+            return
+        self.enabled = True
+        self.hook = hook
+        self.log_path = log_path
+        self.profile_path = profile_path
+        self.started = datetime.now()
+        self.start_time = time.time()
+        self.phases = {}
+        self.counts = {}
+        self.profile = None
+        if profile_path is not None:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def phase(self, name):
+        """Returns a context manager adding the time spent in it to the phase
+        name."""
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def add(self, name, seconds):
+        count, total = self.phases.get(name, (0, 0.0))
+        self.phases[name] = (count + 1, total + seconds)
+
+    def count(self, name, number=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + number
+
+    def iterate(self, name, items):
+        """Returns an iterator over the iterable items that adds the time spent
+        waiting for each item to the phase name."""
+        if not self.enabled:
+            return items
+        return self.timed_items(name, items)
+
+    def timed_items(self, name, items):
+        items = iter(items)
+        while True:
+            start = time.time()
+            try:
+                item = items.next()
+            except StopIteration:
+                self.add(name, time.time() - start)
+                return
+            self.add(name, time.time() - start)
+            yield item
+
+    def finish(self, status):
+        """Appends the record of the push, and its profile, to the logs."""
+        if not self.enabled:
+            return
+        self.enabled = False
+        record = {'hook': self.hook,
+                  'start': self.started.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'pid': os.getpid(),
+                  'status': status,
+                  'seconds': round(time.time() - self.start_time, 6),
+                  'counts': self.counts,
+                  'phases': dict([(name, [count, round(total, 6)])
+                                  for name, (count, total)
+                                  in self.phases.iteritems()])}
+        log = open(self.log_path, 'a')
+        try:
+            log.write(json.dumps(record, sort_keys=True) + '\n')
+        finally:
+            log.close()
+
+        if self.profile is not None:
+            import pstats
+            self.profile.disable()
+            log = open(self.profile_path, 'a')
+            try:
+                log.write('%s %s (pid %s)\n' % (record['start'], self.hook,
+                                                record['pid']))
+                stats = pstats.Stats(self.profile, stream=log)
+                stats.sort_stats('cumulative').print_stats(40)
+            finally:
+                log.close()
+            self.profile = None
+
+# The timing of the push being handled by this process.
+timing = Timing()
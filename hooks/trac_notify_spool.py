@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+# trac_notify_spool
+# ----------------------------------------------------------------------------
+# Copyright (c) 2012 Jens Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+# ----------------------------------------------------------------------------
+
+# Spool for the ticket notifications of trac-post-receive-hook.py.
+#
+# The post-receive hook does not talk to the mail relay itself, it only
+# records which tickets were changed in a SQLite database in the db directory
+# of the Trac environment. This script drains that spool: it sends the
+# notifications of each batch through a single SMTP connection, unless the
+# [notification] email_sender of Trac 0.12 and later is not SmtpEmailSender
+# (e.g. SendmailEmailSender), and leaves failed notifications in the spool to
+# be retried later, with an increasing delay.
+#
+# It is started in the background by the post-receive hook after every push,
+# and can be run from cron as well to retry failed notifications:
+#
+#   python trac_notify_spool.py /path/to/trac/env
+#
+# Keep this file next to trac-post-receive-hook.py.
+
+import sys
+import os
+import fcntl
+import sqlite3
+import calendar
+import tempfile
+import time
+from subprocess import Popen
+from datetime import datetime, timedelta
+
+SPOOL_NAME = 'notify-spool.db'
+LOG_NAME = 'notify-spool.log'
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 10
+# Delay in seconds before the first retry, doubled after every failure.
+RETRY_DELAY = 60
+
+# Use the egg cache of the environment if not other python egg cache is given.
+if not 'PYTHON_EGG_CACHE' in os.environ:
+    os.environ['PYTHON_EGG_CACHE'] = '/tmp/.egg-cache'
+
+
+def to_microseconds(dt):
+    return calendar.timegm(dt.utctimetuple()) * 1000000 + dt.microsecond
+
+
+def from_microseconds(us):
+    from trac.util.datefmt import utc
+
+    return datetime(1970, 1, 1, tzinfo=utc) + timedelta(microseconds=us)
+
+
+class PendingNotifications(object):
+    """Notifications of a push that may not be spooled before the push is
+    committed, kept in a temporary file so a push of any number of ticket
+    changes takes the same amount of memory."""
+
+    def __init__(self):
+        self.file = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, tkt_id, modtime):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile()
+        self.file.write('%d %d\n' % (int(tkt_id), to_microseconds(modtime)))
+        self.count += 1
+
+    def __iter__(self):
+        """Yields the (ticket id, modification time) pairs added so far."""
+        if self.file is None:
+            return
+        self.file.seek(0)
+        for line in self.file:
+            tkt_id, modtime = line.split()
+            yield int(tkt_id), from_microseconds(int(modtime))
+
+    def clear(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.count = 0
+
+
+class NotifySpool(object):
+    """Durable queue of ticket notifications, kept in a SQLite database in the
+    db directory of the Trac environment."""
+
+    def __init__(self, env_path):
+        self.path = os.path.join(env_path, 'db', SPOOL_NAME)
+        self.cnx = sqlite3.connect(self.path, timeout=60)
+        self.cnx.execute('CREATE TABLE IF NOT EXISTS notify_spool ('
+                         'id INTEGER PRIMARY KEY, '
+                         'ticket INTEGER NOT NULL, '
+                         'modtime INTEGER NOT NULL, '
+                         'newticket INTEGER NOT NULL DEFAULT 0, '
+                         'attempts INTEGER NOT NULL DEFAULT 0, '
+                         'next_attempt INTEGER NOT NULL DEFAULT 0, '
+                         'error TEXT)')
+        self.cnx.execute('CREATE INDEX IF NOT EXISTS notify_spool_due_idx '
+                         'ON notify_spool (next_attempt)')
+        self.cnx.commit()
+
+    def enqueue(self, notifications):
+        """Adds the (ticket id, modification time) pairs of the iterable
+        notifications to the spool."""
+        self.cnx.executemany('INSERT INTO notify_spool (ticket, modtime) '
+                             'VALUES (?, ?)',
+                             ((int(tkt_id), to_microseconds(modtime))
+                              for tkt_id, modtime in notifications))
+        self.cnx.commit()
+
+    def due(self, size=BATCH_SIZE):
+        """Returns up to size notifications that should be sent now, as
+        (id, ticket id, modification time, newticket, attempts) tuples."""
+        cursor = self.cnx.execute('SELECT id, ticket, modtime, newticket, '
+                                  'attempts FROM notify_spool '
+                                  'WHERE next_attempt <= ? AND attempts < ? '
+                                  'ORDER BY id LIMIT ?',
+                                  (int(time.time()), MAX_ATTEMPTS, size))
+        return [(id, tkt_id, from_microseconds(modtime), newticket, attempts)
+                for id, tkt_id, modtime, newticket, attempts in cursor]
+
+    def pending(self):
+        """Returns the number of notifications that can still be sent."""
+        cursor = self.cnx.execute('SELECT COUNT(*) FROM notify_spool '
+                                  'WHERE attempts < ?', (MAX_ATTEMPTS,))
+        return cursor.fetchone()[0]
+
+    def done(self, id):
+        self.cnx.execute('DELETE FROM notify_spool WHERE id=?', (id,))
+        self.cnx.commit()
+
+    def failed(self, id, attempts, error):
+        """Schedules a retry of notification id, which failed for the
+        attempts'th time."""
+        next_attempt = int(time.time()) + RETRY_DELAY * 2 ** (attempts - 1)
+        self.cnx.execute('UPDATE notify_spool SET attempts=?, next_attempt=?, '
+                         'error=? WHERE id=?',
+                         (attempts, next_attempt, str(error), id))
+        self.cnx.commit()
+
+    def lock(self):
+        """Blocks until this process is the only one draining the spool."""
+        self.lockfile = open(self.path + '.lock', 'w')
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+
+
+class SharedConnection(object):
+    """Lets all notifications of a batch send through one SMTP connection.
+
+    Trac 0.11's NotifyEmail connects in begin_send and disconnects in
+    finish_send; attach replaces both, so only the first notification connects
+    and the connection is closed by close. Trac 0.12 and later send every mail
+    through the IEmailSender of the [notification] email_sender option, whose
+    SmtpEmailSender connects for every mail. When that is the sender, install
+    puts send, which implements IEmailSender on a connection of its own, in
+    its place until uninstall.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.shared = None
+        self.system = None
+        self.sender = None
+
+    def install(self, env):
+        try:
+            from trac.notification import NotificationSystem
+        except ImportError:
+            return
+        system = NotificationSystem(env)
+        if not hasattr(system, 'send_email') or \
+                env.config.get('notification', 'email_sender',
+                               'SmtpEmailSender') != 'SmtpEmailSender':
+            return
+        self.sender = system.email_sender
+        self.system = system
+        system.send_email = self.send
+
+    def uninstall(self):
+        self.close()
+        if self.system is not None:
+            del self.system.send_email
+            self.system = None
+
+    def send(self, from_addr, recipients, message):
+        """Sends message like SmtpEmailSender, over the connection of the
+        batch."""
+        import smtplib
+        from trac.core import TracError
+        from trac.util.text import CRLF, fix_eol
+
+        sender = self.sender
+        if self.server is None:
+            server = smtplib.SMTP(sender.smtp_server, sender.smtp_port)
+            if sender.use_tls:
+                server.ehlo()
+                if not server.has_extn('starttls'):
+                    raise TracError('TLS enabled but server does not support '
+                                    'TLS')
+                server.starttls()
+                server.ehlo()
+            if sender.smtp_user:
+                server.login(sender.smtp_user.encode('utf-8'),
+                             sender.smtp_password.encode('utf-8'))
+            self.server = server
+        self.server.sendmail(from_addr, recipients, fix_eol(message, CRLF))
+
+    def attach(self, notify_email):
+        if self.shared is False:
+            return
+        def begin_send():
+            if self.server is None:
+                type(notify_email).begin_send(notify_email)
+                self.server = getattr(notify_email, 'server', None)
+                self.shared = self.server is not None
+                if not self.shared:
+                    del notify_email.finish_send
+                    return
+            notify_email.server = self.server
+        notify_email.begin_send = begin_send
+        notify_email.finish_send = lambda: None
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+
+def drain(env, spool):
+    """Sends all due notifications in spool, returns the number of sent and
+    failed notifications."""
+    from trac.ticket import Ticket
+    from trac.ticket.notification import TicketNotifyEmail
+
+    sent = failed = 0
+    while True:
+        batch = spool.due()
+        if not batch:
+            break
+        connection = SharedConnection()
+        connection.install(env)
+        try:
+            for id, tkt_id, modtime, newticket, attempts in batch:
+                try:
+                    ticket = Ticket(env, tkt_id)
+                    tn = TicketNotifyEmail(env)
+                    connection.attach(tn)
+                    tn.notify(ticket, newticket=newticket, modtime=modtime)
+                except Exception, e:
+                    print 'Notification for ticket %s failed (attempt %s): %s' % (
+                        tkt_id, attempts + 1, e)
+                    spool.failed(id, attempts + 1, e)
+                    # The connection may be broken, start over with a new one.
+                    connection.close()
+                    failed += 1
+                else:
+                    spool.done(id)
+                    sent += 1
+        finally:
+            connection.uninstall()
+    return sent, failed
+
+
+def spawn_worker(env_path):
+    """Starts this script in the background to drain the spool of env_path,
+    without keeping the pushing client waiting for it."""
+    devnull = open(os.devnull, 'r')
+    log = open(os.path.join(env_path, 'log', LOG_NAME), 'a')
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    Popen([sys.executable, script, env_path], stdin=devnull, stdout=log,
+          stderr=log, close_fds=True, preexec_fn=os.setsid)
+
+
+if __name__ == '__main__':
+    from trac.env import open_environment
+
+    if len(sys.argv) != 2:
+        print 'Usage: %s /path/to/trac/env' % sys.argv[0]
+        sys.exit(1)
+    env = open_environment(sys.argv[1])
+    spool = NotifySpool(env.path)
+    spool.lock()
+    sent, failed = drain(env, spool)
+    print '%s: %s notifications sent, %s failed' % (
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S'), sent, failed)
@@ -0,0 +1,121 @@
+# trac_push_refs
+# ----------------------------------------------------------------------------
+# Copyright (c) 2012 Jens Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+# ----------------------------------------------------------------------------
+
+# Selection of the pushed refs, shared by trac-pre-receive-hook.py and
+# trac-post-receive-hook.py. Keep this file next to the hooks.
+#
+# The BRANCHES of the hooks are branch names, glob patterns like 'release/*'
+# (see fnmatch, a '*' matches a '/' as well) or compiled regular expressions
+# like re.compile(r'feature/[0-9]+'), which have to match the whole name.
+#
+# The hooks read all ref update lines of a push first and select the new
+# commits of all checked refs with a single git process, so a commit pushed
+# to several branches at once is read and handled only once. RefTracker tells
+# which of the pushed refs each of those commits is on.
+
+import re
+from fnmatch import translate
+
+NULL_SHA = '0' * 40
+
+
+def branch_patterns(branches):
+    """Returns the compiled regular expressions of the names, glob patterns
+    and regular expressions in branches."""
+    patterns = []
+    for branch in branches:
+        if isinstance(branch, basestring):
+            branch = re.compile(translate(branch))
+        patterns.append(branch)
+    return patterns
+
+
+def is_checked_ref(ref, patterns):
+    """Returns whether ref is a branch matched by one of patterns."""
+    if not ref.startswith('refs/heads/'):
+        return False
+    name = ref[11:]
+    for pattern in patterns:
+        match = pattern.match(name)
+        if match and match.end() == len(name):
+            return True
+    return False
+
+
+def ref_updates(lines, patterns):
+    """Returns the (old, new, ref) updates of the ref update lines of a push
+    that create or move a branch matched by patterns."""
+    updates = []
+    for line in lines:
+        old, new, ref = line.split()
+        if new != NULL_SHA and is_checked_ref(ref, patterns):
+            updates.append((old, new, ref))
+    return updates
+
+
+def push_args(updates, exclude=None):
+    """Returns the rev-list arguments selecting the new commits of all updates
+    at once: the commits reachable from any of the new values and from none
+    of the refs in exclude, or if that is not given, from none of the old
+    values."""
+    args = sorted(set([new for old, new, ref in updates]))
+    if exclude:
+        args += ['--not'] + exclude
+    else:
+        args += sorted(set(['^' + old for old, new, ref in updates
+                            if old != NULL_SHA]))
+    return args
+
+
+class RefTracker(object):
+    """Finds the pushed refs each of the commits selected by push_args is on.
+
+    The commits have to be passed to refs newest first, as git log
+    --topo-order lists them, which shows every commit before its parents. The
+    refs of a commit are then complete when it is passed, and are handed down
+    to its parents. Only the refs of the commits of which no parent has been
+    seen yet are kept, and equal sets of refs are shared.
+    """
+
+    def __init__(self, updates):
+        self.sets = {}
+        self.pending = {}
+        for old, new, ref in updates:
+            self.pending[new] = self.pending.get(new, frozenset()) | \
+                                frozenset([ref])
+        for sha, refs in self.pending.items():
+            self.pending[sha] = self.sets.setdefault(refs, refs)
+
+    def refs(self, sha, parents):
+        """Returns the frozenset of the pushed refs commit sha, with the full
+        hashes parents, is on."""
+        refs = self.pending.pop(sha, frozenset())
+        for parent in parents:
+            inherited = self.pending.get(parent)
+            if inherited is None:
+                self.pending[parent] = refs
+            elif not refs <= inherited:
+                inherited = inherited | refs
+                self.pending[parent] = self.sets.setdefault(inherited,
+                                                            inherited)
+        return refs
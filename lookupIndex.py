@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# This script creates a lookup index, matching SVN revision IDs with GIT
+# revision IDs. Run it inside a GIT repository that is imported from SVN with
+# "git svn".
+#
+# Usage:
+#	lookupIndex.py [lookupIndex.bin]
+#		writes the binary index (default: lookupIndex.bin)
+#	lookupIndex.py --text > lookupTable.txt
+#		writes the old tab separated text table
+#	lookupIndex.py --export lookupIndex.bin > lookupTable.txt
+#		converts a binary index to the text table
+#
+# The binary index is a small header followed by a dense array of 20 byte
+# hashes, indexed by SVN revision, with zero bytes for revisions without a
+# GIT commit. LookupIndex memory maps it, so lookups need no loading step.
+
+import sys
+import os
+import re
+import mmap
+import struct
+import binascii
+from subprocess import Popen, PIPE
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'hooks'))
+from trac_git_log import read_records
+
+GIT_PATH = 'git'
+
+MAGIC = 'SVNGITv1'
+HEADER = struct.Struct('<8sI')
+HASH_SIZE = 20
+MISSING = '\0' * HASH_SIZE
+
+svn_id_re = re.compile(r'^git-svn-id: \S*@([0-9]+) ', re.MULTILINE)
+
+
+def read_revisions(args=['--all']):
+    """Yields (SVN revision, GIT hash) for every commit with a git-svn-id
+    selected by the rev-list arguments args, using one git log process."""
+    proc = Popen([GIT_PATH, 'log', '-z', '--format=%H%x1f%B',
+                  '--grep=^git-svn-id: '] + args, stdout=PIPE)
+    try:
+        for record in read_records(proc.stdout):
+            sha, body = record.split('\x1f', 1)
+            match = svn_id_re.search(body)
+            if match:
+                yield int(match.group(1)), sha
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def build(path, revisions):
+    """Writes the binary index of the (revision, hash) pairs revisions to
+    path. When a revision occurs more than once the first hash is kept."""
+    out = open(path, 'w+b')
+    out.write(HEADER.pack(MAGIC, 0))
+    size = 0
+    for revision, sha in revisions:
+        offset = HEADER.size + revision * HASH_SIZE
+        if revision < size:
+            out.seek(offset)
+            if out.read(HASH_SIZE) != MISSING:
+                continue
+        out.seek(offset)
+        out.write(binascii.unhexlify(sha))
+        size = max(size, revision + 1)
+    out.seek(0)
+    out.write(HEADER.pack(MAGIC, size))
+    out.close()
+
+
+class LookupIndex(object):
+    """Read-only, memory mapped SVN revision -> GIT hash index."""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        magic, self.size = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('%s is not a lookup index' % path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, revision, default=None):
+        """Returns the hex GIT hash of SVN revision."""
+        if not 0 <= revision < self.size:
+            return default
+        offset = HEADER.size + revision * HASH_SIZE
+        sha = self.map[offset:offset + HASH_SIZE]
+        if sha == MISSING:
+            return default
+        return binascii.hexlify(sha)
+
+    def iteritems(self):
+        for revision in xrange(self.size):
+            sha = self.get(revision)
+            if sha is not None:
+                yield revision, sha
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def is_index(path):
+    return open(path, 'rb').read(len(MAGIC)) == MAGIC
+
+
+def write_text(items, out):
+    """Writes (revision, hash) pairs in the format of lookupTable.txt."""
+    for revision, sha in items:
+        out.write('%d\t%s\n' % (revision, sha))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[:1] == ['--text']:
+        write_text(sorted(read_revisions()), sys.stdout)
+    elif args[:1] == ['--export'] and len(args) == 2:
+        write_text(LookupIndex(args[1]).iteritems(), sys.stdout)
+    elif len(args) <= 1 and not args[:1] in (['-h'], ['--help']):
+        build(args and args[0] or 'lookupIndex.bin', read_revisions())
+    else:
+        print 'Usage: %s [index] | --text | --export index' % sys.argv[0]
+        sys.exit(1)